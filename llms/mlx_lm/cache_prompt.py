@@ -90,6 +90,9 @@ def main():
         adapter_path=args.adapter_path,
         tokenizer_config=tokenizer_config,
     )
+    # Parameters are loaded in the background, so wait for them here to keep
+    # the load out of the reported speeds
+    mx.eval(model.parameters())
 
     args.prompt = sys.stdin.read() if args.prompt == "-" else args.prompt
 
@@ -474,6 +474,7 @@ class APIHandler(BaseHTTPRequestHandler):
                 repetition_context_size=self.repetition_context_size,
                 logit_bias=self.logit_bias,
                 prompt_cache=self.prompt_cache.cache,
+                include_logprobs=True,
             ),
         ):
             detokenizer.add_token(token)
@@ -2,17 +2,25 @@
 
 import copy
 import glob
+import hashlib
 import importlib
 import json
 import logging
+import os
+import re
 import shutil
 import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 from textwrap import dedent
 from typing import Any, Callable, Dict, Generator, List, Optional, Tuple, Type, Union
 
 import mlx.core as mx
 import mlx.nn as nn
+import numpy as np
 from huggingface_hub import snapshot_download
 from mlx.utils import tree_flatten
 from transformers import PreTrainedTokenizer
@@ -24,6 +32,11 @@ from .tokenizer_utils import TokenizerWrapper, load_tokenizer
 from .tuner.utils import dequantize as dequantize_model
 from .tuner.utils import load_adapters
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Constants
 MODEL_REMAPPING = {
     "mistral": "llama",  # mistral is compatible with llama
@@ -32,6 +45,35 @@ MODEL_REMAPPING = {
 
 MAX_FILE_SIZE_GB = 5
 
+# Matches the prefix shared by all the weights of a layer, e.g. "model.layers.3"
+LAYER_PREFIX_PATTERN = re.compile(r"(.*?layers\.\d+)\.")
+
+# Maximum number of tokens the rate limiter releases back to back
+RATE_LIMIT_BURST = 4
+
+# Number of tokens stream_generate copies to the host at once
+STREAM_TOKEN_BATCH_SIZE = 4
+
+# Prompt prefixes are stored at multiples of this many tokens. A stored
+# prefix is reused up to the point where a new prompt diverges from it.
+PREFIX_CACHE_STRIDE = 64
+
+# Maximum total size of the cached prompt prefixes in bytes
+PREFIX_CACHE_MAX_BYTES = 2 << 30
+
+# Maps a hash of (model, max_kv_size, prefix tokens) to a weak reference to
+# the model, max_kv_size, the prefix tokens, the size of the cache in bytes
+# and the prompt cache itself
+_prefix_cache: OrderedDict = OrderedDict()
+
+
+def _load_json(path: Path) -> Any:
+    if orjson is not None:
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+    with open(path, "r") as f:
+        return json.load(f)
+
 
 class ModelNotFoundError(Exception):
     def __init__(self, message):
@@ -51,6 +93,21 @@ def _get_classes(config: dict):
     """
     model_type = config["model_type"]
     model_type = MODEL_REMAPPING.get(model_type, model_type)
+    return _import_arch(model_type)
+
+
+@lru_cache(maxsize=None)
+def _import_arch(model_type: str):
+    """
+    Import the model module for ``model_type``. The result is cached so
+    repeated loads of the same architecture skip the import machinery.
+
+    Args:
+        model_type (str): The (remapped) model type.
+
+    Returns:
+        A tuple containing the Model class and the ModelArgs class.
+    """
     try:
         arch = importlib.import_module(f"mlx_lm.models.{model_type}")
     except ImportError:
@@ -117,10 +174,10 @@ def apply_repetition_penalty(logits: mx.array, tokens: mx.array, penalty: float)
     """
     if len(tokens) > 0:
         selected_logits = logits[:, tokens]
-        selected_logits = mx.where(
-            selected_logits < 0, selected_logits * penalty, selected_logits / penalty
-        )
-        logits[:, tokens] = selected_logits
+        # Negative logits are scaled up and positive logits are scaled down so
+        # that both become less likely; a single multiply covers both cases
+        scale = mx.where(selected_logits < 0, penalty, 1.0 / penalty)
+        logits[:, tokens] = selected_logits * scale.astype(selected_logits.dtype)
     return logits
 
 def generate_step(
@@ -138,7 +195,10 @@ def generate_step(
     prompt_cache: Optional[Any] = None,
     logit_bias: Optional[Dict[int, float]] = None,
     logits_processor: Optional[List[Callable[[mx.array, mx.array], mx.array]]] = None,
-) -> Generator[Tuple[mx.array, mx.array], None, None]:
+    include_logprobs: bool = False,
+    token_batch_size: int = 1,
+    prompt_prefix: Optional[mx.array] = None,
+) -> Generator[Tuple[mx.array, Optional[mx.array]], None, None]:
     """
     A generator producing token ids based on the given prompt from the model.
 
@@ -146,6 +206,9 @@ def generate_step(
         prompt (mx.array): The input prompt.
         model (nn.Module): The model to use for generation.
         temp (float): The temperature for sampling, if 0 the argmax is used. Default: ``0``.
+        max_tokens_per_sec (float, optional): If set, limits generation speed to
+          approximately max_tokens_per_sec. Short bursts of up to
+          ``RATE_LIMIT_BURST`` tokens are allowed to catch up after a stall.
         repetition_penalty (float, optional): The penalty factor for repeating
           tokens.
         repetition_context_size (int, optional): The number of tokens to
@@ -165,15 +228,27 @@ def generate_step(
         logits_processor (List[Callable[[mx.array, mx.array], mx.array]], optional):
             A list of functions that take tokens and logits and return the processed
             logits. Default: ``None``.
+        include_logprobs (bool): Whether to compute the vector of log
+          probabilities for each token. If ``False``, ``None`` is yielded in
+          its place. Default: ``False``.
+        token_batch_size (int): The number of tokens computed per host-device
+          synchronization. Tokens are still yielded one at a time. Steps
+          computed past the last consumed token are trimmed from the prompt
+          cache when the generator is closed. A given ``prompt_cache`` which
+          is not made only of ``KVCache`` layers always uses a batch size of
+          ``1``. Default: ``1``.
+        prompt_prefix (mx.array, optional): Tokens preceding the prompt which
+          are already processed in the ``prompt_cache``. They are only used
+          for the repetition penalty. Default: ``None``.
 
     Yields:
-        Generator[Tuple[mx.array, mx.array], None, None]: A generator producing
-          one token and a vector of log probabilities.
+        Generator[Tuple[mx.array, Optional[mx.array]], None, None]: A generator
+          producing one token and a vector of log probabilities.
     """
-    def sample(logits: mx.array) -> Tuple[mx.array, float]:
-        logprobs = logits - mx.logsumexp(logits)
-
+    def sample(logits: mx.array) -> mx.array:
         if temp == 0:
+            # Take the argmax in the logits' own precision. Downcasting first
+            # costs an extra pass over the vocabulary and can introduce ties.
             token = mx.argmax(logits, axis=-1)
         else:
             if top_p > 0 and top_p < 1.0:
@@ -183,7 +258,7 @@ def generate_step(
             else:
                 token = categorical_sampling(logits, temp)
 
-        return token, logprobs
+        return token
 
     if repetition_penalty and (
         repetition_penalty < 0 or not isinstance(repetition_penalty, float)
@@ -192,6 +267,11 @@ def generate_step(
             f"repetition_penalty must be a non-negative float, got {repetition_penalty}"
         )
         
+    if not isinstance(token_batch_size, int) or token_batch_size < 1:
+        raise ValueError(
+            f"token_batch_size must be a positive integer, got {token_batch_size}"
+        )
+
     if max_tokens_per_sec is not None:
         if not isinstance(max_tokens_per_sec, (int, float)) or max_tokens_per_sec <= 0:
             raise ValueError(
@@ -199,24 +279,24 @@ def generate_step(
             )
 
     logits_processor = logits_processor or []
-    last_token_time = time.perf_counter()  # Track time for rate limiting
 
+    # Only the last repetition_context_size tokens are needed for the
+    # repetition penalty, so keep them in a bounded buffer instead of the full
+    # token history
     if repetition_penalty:
-        def repetition_penalty_processor(tokens, logits):
-            return apply_repetition_penalty(
-                logits, tokens[-repetition_context_size:], repetition_penalty
-            )
-        logits_processor.append(repetition_penalty_processor)
-
+        repetition_context = prompt
+        if prompt_prefix is not None:
+            repetition_context = mx.concat([prompt_prefix, repetition_context])
+        if repetition_context_size:
+            repetition_context = repetition_context[-repetition_context_size:]
+
+    # The bias is fixed for the whole generation, so it is scattered once into
+    # a dense vector on the first step and added at every step. It does not
+    # need the token history, so it is not a logits processor.
+    dense_bias = None
     if logit_bias:
-        indices = mx.array(list(logit_bias.keys()))
-        values = mx.array(list(logit_bias.values()))
-
-        def logit_bias_processor(_, logits):
-            logits[:, indices] += values
-            return logits
-
-        logits_processor.append(logit_bias_processor)
+        bias_indices = mx.array(list(logit_bias.keys()))
+        bias_values = mx.array(list(logit_bias.values()))
 
     y = prompt
     tokens = None
@@ -226,6 +306,10 @@ def generate_step(
         prompt_cache = cache.make_prompt_cache(model, max_kv_size)
     elif len(prompt_cache) != len(model.layers):
         raise ValueError("Wrong number of layers in the prompt cache.")
+    elif not all(type(c) is cache.KVCache for c in prompt_cache):
+        # Only a KVCache can always be trimmed back to the consumed tokens, so
+        # any other cache is advanced one token at a time
+        token_batch_size = 1
 
     def _step(y):
         logits = model(y[None], cache=prompt_cache)
@@ -238,35 +322,191 @@ def generate_step(
             for processor in logits_processor:
                 logits = processor(tokens, logits)
 
-        y, logprobs = sample(logits)
+        if repetition_penalty:
+            nonlocal repetition_context
+            logits = apply_repetition_penalty(
+                logits, repetition_context, repetition_penalty
+            )
+
+        if logit_bias:
+            nonlocal dense_bias
+            if dense_bias is None:
+                dense_bias = mx.zeros(logits.shape[-1], dtype=logits.dtype)
+                dense_bias[bias_indices] = bias_values.astype(logits.dtype)
+            logits = logits + dense_bias
+
+        y = sample(logits)
+
+        if repetition_penalty:
+            repetition_context = mx.concat([repetition_context, y])
+            if repetition_context_size:
+                repetition_context = repetition_context[-repetition_context_size:]
+
+        if not include_logprobs:
+            return y, None
+
+        # The log probabilities are left unevaluated so they are only computed
+        # if the caller actually uses them
+        logprobs = logits - mx.logsumexp(logits, axis=-1, keepdims=True)
         return y, logprobs.squeeze(0)
 
-    while y.size > prefill_step_size:
-        model(y[:prefill_step_size][None], cache=prompt_cache)
+    # Process the prompt in chunks, leaving the last chunk for the first step.
+    # The cache is cleared once at the end so the allocator can reuse buffers
+    # between chunks.
+    prefill_size = (y.size - 1) // prefill_step_size * prefill_step_size
+    for i in range(0, prefill_size, prefill_step_size):
+        model(y[i : i + prefill_step_size][None], cache=prompt_cache)
         mx.eval([c.state for c in prompt_cache])
-        y = y[prefill_step_size:]
+    if prefill_size > 0:
+        y = y[prefill_size:]
         mx.metal.clear_cache()
 
-    y, logprobs = _step(y)
+    num_steps = 0
+    num_yielded = 0
+
+    def _dispatch(y):
+        nonlocal num_steps
+        batch = []
+        for _ in range(token_batch_size):
+            y, logprobs = _step(y)
+            mx.async_eval(y)
+            batch.append((y, logprobs))
+            num_steps += 1
+        return batch
+
+    # Token bucket for rate limiting. The next batch is already dispatched
+    # when waiting, so its computation overlaps the sleep.
+    bucket = 1.0
+    last_refill = time.perf_counter()
+
+    def _refill():
+        nonlocal bucket, last_refill
+        now = time.perf_counter()
+        bucket = min(
+            RATE_LIMIT_BURST, bucket + (now - last_refill) * max_tokens_per_sec
+        )
+        last_refill = now
+
+    batch = _dispatch(y)
+    try:
+        while True:
+            next_batch = _dispatch(batch[-1][0])
+
+            # A single synchronization for the whole batch
+            batch_tokens = mx.concatenate([y for y, _ in batch]).tolist()
+            for token, (_, logprobs) in zip(batch_tokens, batch):
+                if max_tokens_per_sec is not None:
+                    _refill()
+                    if bucket < 1:
+                        time.sleep((1 - bucket) / max_tokens_per_sec)
+                        _refill()
+                    bucket -= 1
+
+                num_yielded += 1
+                yield token, logprobs
+            batch = next_batch
+    finally:
+        # The first step processes the end of the prompt and every later step
+        # processes the previous token. Remove the steps whose input token was
+        # never consumed so the cache matches the prompt and yielded tokens.
+        num_unconsumed = num_steps - 1 - num_yielded
+        if num_unconsumed > 0:
+            cache.trim_prompt_cache(prompt_cache, num_unconsumed)
+
+
+def _prefix_key(model: nn.Module, max_kv_size: Optional[int], tokens: np.ndarray):
+    hasher = hashlib.blake2b(f"{id(model)}:{max_kv_size}:".encode())
+    hasher.update(tokens)
+    return hasher.digest()
+
+
+def _common_prefix_length(a: np.ndarray, b: np.ndarray) -> int:
+    n = min(a.size, b.size)
+    mismatch = np.flatnonzero(a[:n] != b[:n])
+    return int(mismatch[0]) if mismatch.size > 0 else n
+
+
+def _store_prefix_cache(
+    model: nn.Module,
+    max_kv_size: Optional[int],
+    tokens: np.ndarray,
+    prompt_cache: List[Any],
+):
+    nbytes = sum(v.nbytes for _, v in tree_flatten([c.state for c in prompt_cache]))
+    if nbytes > PREFIX_CACHE_MAX_BYTES:
+        return
+
+    key = _prefix_key(model, max_kv_size, tokens)
+    _prefix_cache[key] = (
+        weakref.ref(model),
+        max_kv_size,
+        tokens,
+        nbytes,
+        copy.deepcopy(prompt_cache),
+    )
+    total = sum(entry[3] for entry in _prefix_cache.values())
+    while total > PREFIX_CACHE_MAX_BYTES:
+        _, entry = _prefix_cache.popitem(last=False)
+        total -= entry[3]
+
+
+def _fetch_prefix_cache(
+    model: nn.Module,
+    prompt_tokens: mx.array,
+    max_kv_size: Optional[int] = None,
+    prefill_step_size: int = 512,
+) -> Tuple[List[Any], mx.array]:
+    """
+    Get a prompt cache for the longest cached prefix of the prompt and process
+    the remaining prompt up to the last full stride so it can be reused.
 
-    mx.async_eval(y, logprobs)
-    last_target_time = time.perf_counter()  # Track when we WANTED the last token
-    
-    while True:
-        next_y, next_logprobs = _step(y)
-        mx.async_eval(next_y, next_logprobs)
+    A stored prefix is used as is if the prompt extends it. Otherwise, if the
+    cache can be trimmed, it is trimmed back to where the prompt diverges.
 
-        if max_tokens_per_sec is not None:
-            target_time = 1.0 / max_tokens_per_sec
-            last_target_time += target_time  # When we want next token
-            
-            # Sleep until target time if needed
-            sleep_time = last_target_time - time.perf_counter()
-            if sleep_time > 0:
-                time.sleep(sleep_time)
+    Returns:
+        Tuple[List[Any], mx.array]: The prompt cache and the prompt tokens
+          which still need to be processed.
+    """
+    tokens = np.array(prompt_tokens, dtype=np.int32)
+
+    # Leave at least one token to be processed by generate_step
+    max_prefix = tokens.size - 1
+
+    best_key, best_length = None, 0
+    for key, (model_ref, kv_size, prefix, _, prompt_cache) in _prefix_cache.items():
+        if model_ref() is not model or kv_size != max_kv_size:
+            continue
+        length = min(_common_prefix_length(prefix, tokens), max_prefix)
+        if length < prefix.size and not cache.can_trim_prompt_cache(prompt_cache):
+            continue
+        if length > best_length:
+            best_key, best_length = key, length
+
+    start = best_length
+    end = max_prefix // PREFIX_CACHE_STRIDE * PREFIX_CACHE_STRIDE
+    if best_key is not None:
+        _prefix_cache.move_to_end(best_key)
+        _, _, prefix, _, prompt_cache = _prefix_cache[best_key]
+        prompt_cache = copy.deepcopy(prompt_cache)
+        cache.trim_prompt_cache(prompt_cache, prefix.size - start)
+
+        # A trimmable prefix which the prompt extends is superseded by the
+        # longer prefix stored below
+        if start == prefix.size < end and cache.can_trim_prompt_cache(prompt_cache):
+            del _prefix_cache[best_key]
+    else:
+        prompt_cache = cache.make_prompt_cache(model, max_kv_size)
+
+    if start < end:
+        for i in range(start, end, prefill_step_size):
+            chunk = prompt_tokens[i : min(i + prefill_step_size, end)]
+            model(chunk[None], cache=prompt_cache)
+            mx.eval([c.state for c in prompt_cache])
+        _store_prefix_cache(model, max_kv_size, tokens[:end], prompt_cache)
+        start = end
+
+    return prompt_cache, prompt_tokens[start:]
 
-        yield y.item(), logprobs
-        y, logprobs = next_y, next_logprobs
 
 def stream_generate(
     model: nn.Module,
@@ -274,6 +514,7 @@ def stream_generate(
     prompt: str,
     max_tokens: int = 100,
     max_tokens_per_sec: Optional[float] = None,  # Add parameter
+    prefix_cache: bool = False,
     **kwargs,
 ) -> Union[str, Generator[str, None, None]]:
     """
@@ -284,8 +525,13 @@ def stream_generate(
         model (nn.Module): The model to use for generation.
         max_tokens (int): The maximum number of tokens. Default: ``100``.
         max_tokens_per_sec (float, optional): If set, limits generation speed to approximately max_tokens_per_sec. May go slightly over this limit.
+        prefix_cache (bool): If ``True``, reuse and update a shared cache of
+          processed prompt prefixes. Ignored if ``prompt_cache`` is given.
+          Default: ``False``.
         kwargs: The remaining options get passed to :func:`generate_step`.
-          See :func:`generate_step` for more details.
+          See :func:`generate_step` for more details. Tokens are synchronized
+          in batches of ``STREAM_TOKEN_BATCH_SIZE`` unless ``token_batch_size``
+          is given.
 
     Yields:
         Generator[Tuple[mx.array, mx.array]]: A generator producing text.
@@ -293,14 +539,26 @@ def stream_generate(
 
     if not isinstance(tokenizer, TokenizerWrapper):
         tokenizer = TokenizerWrapper(tokenizer)
+    kwargs.setdefault("token_batch_size", STREAM_TOKEN_BATCH_SIZE)
 
-    prompt_tokens = mx.array(tokenizer.encode(prompt))
+    prompt_tokens = mx.array(tokenizer.encode(prompt), dtype=mx.int32)
+    prompt_suffix = prompt_tokens
+    if prefix_cache and kwargs.get("prompt_cache") is None:
+        kwargs["prompt_cache"], prompt_suffix = _fetch_prefix_cache(
+            model,
+            prompt_tokens,
+            kwargs.get("max_kv_size"),
+            kwargs.get("prefill_step_size", 512),
+        )
+        kwargs["prompt_prefix"] = prompt_tokens[
+            : prompt_tokens.size - prompt_suffix.size
+        ]
     detokenizer = tokenizer.detokenizer
 
     detokenizer.reset()
     for n, (token, _) in zip(
         range(max_tokens),
-        generate_step(prompt_tokens, model, max_tokens_per_sec=max_tokens_per_sec, **kwargs),
+        generate_step(prompt_suffix, model, max_tokens_per_sec=max_tokens_per_sec, **kwargs),
     ):
         if token == tokenizer.eos_token_id:
             break
@@ -319,6 +577,7 @@ def generate(
     max_tokens_per_sec: Optional[float] = None,  # Add parameter
     verbose: bool = False,
     formatter: Optional[Callable] = None,
+    prefix_cache: bool = False,
     **kwargs,
 ) -> Union[str, Generator[str, None, None]]:
     """
@@ -334,6 +593,9 @@ def generate(
            Default: ``False``.
        formatter (Optional[Callable]): A function which takes a token and a
            probability and displays it.
+       prefix_cache (bool): If ``True``, reuse and update a shared cache of
+           processed prompt prefixes. Ignored if ``prompt_cache`` is given.
+           Default: ``False``.
        kwargs: The remaining options get passed to :func:`generate_step`.
           See :func:`generate_step` for more details.
     """
@@ -344,15 +606,31 @@ def generate(
         print("=" * 10)
         print("Prompt:", prompt)
 
-    prompt_tokens = mx.array(tokenizer.encode(prompt))
+    # Log probabilities are only needed to display token probabilities
+    if verbose and formatter:
+        kwargs["include_logprobs"] = True
+
+    prompt_tokens = mx.array(tokenizer.encode(prompt), dtype=mx.int32)
     detokenizer = tokenizer.detokenizer
 
     tic = time.perf_counter()
     detokenizer.reset()
 
+    prompt_suffix = prompt_tokens
+    if prefix_cache and kwargs.get("prompt_cache") is None:
+        kwargs["prompt_cache"], prompt_suffix = _fetch_prefix_cache(
+            model,
+            prompt_tokens,
+            kwargs.get("max_kv_size"),
+            kwargs.get("prefill_step_size", 512),
+        )
+        kwargs["prompt_prefix"] = prompt_tokens[
+            : prompt_tokens.size - prompt_suffix.size
+        ]
+
     for n, (token, logprobs) in zip(
         range(max_tokens),
-        generate_step(prompt_tokens, model, max_tokens_per_sec=max_tokens_per_sec, **kwargs),
+        generate_step(prompt_suffix, model, max_tokens_per_sec=max_tokens_per_sec, **kwargs),
     ):
         if n == 0:
             prompt_time = time.perf_counter() - tic
@@ -393,8 +671,7 @@ def generate(
 
 def load_config(model_path: Path) -> dict:
     try:
-        with open(model_path / "config.json", "r") as f:
-            config = json.load(f)
+        config = _load_json(model_path / "config.json")
     except FileNotFoundError:
         logging.error(f"Config file not found in {model_path}")
         raise
@@ -412,9 +689,10 @@ def load_model(
 
     Args:
         model_path (Path): The path to load the model from.
-        lazy (bool): If False eval the model parameters to make sure they are
-            loaded in memory before returning, otherwise they will be loaded
-            when needed. Default: ``False``
+        lazy (bool): If False start evaluating the model parameters so they
+            are loaded in memory in the background, otherwise they will be
+            loaded when needed. Use ``mx.eval(model.parameters())`` to wait
+            for them, e.g. before timing generation. Default: ``False``
         model_config (dict, optional): Configuration parameters for the model.
             Defaults to an empty dictionary.
         get_model_classes (Callable[[dict], Tuple[Type[nn.Module], Type]], optional):
@@ -432,11 +710,19 @@ def load_model(
     config = load_config(model_path)
     config.update(model_config)
 
-    weight_files = glob.glob(str(model_path / "model*.safetensors"))
+    # List the directory once and sort so the load order is deterministic
+    safetensors = sorted(
+        entry.name
+        for entry in os.scandir(model_path)
+        if entry.name.endswith(".safetensors")
+    )
+    weight_files = [str(model_path / f) for f in safetensors if f.startswith("model")]
 
     if not weight_files:
         # Try weight for back-compat
-        weight_files = glob.glob(str(model_path / "weight*.safetensors"))
+        weight_files = [
+            str(model_path / f) for f in safetensors if f.startswith("weight")
+        ]
 
     if not weight_files:
         logging.error(f"No safetensors found in {model_path}")
@@ -469,8 +755,10 @@ def load_model(
 
     model.load_weights(list(weights.items()))
 
+    # Load the parameters asynchronously so that loading overlaps with any
+    # work the caller does before the model is first used
     if not lazy:
-        mx.eval(model.parameters())
+        mx.async_eval(model.parameters())
 
     model.eval()
     return model
@@ -494,9 +782,10 @@ def load(
             Defaults to an empty dictionary.
         adapter_path (str, optional): Path to the LoRA adapters. If provided, applies LoRA layers
             to the model. Default: ``None``.
-        lazy (bool): If False eval the model parameters to make sure they are
-            loaded in memory before returning, otherwise they will be loaded
-            when needed. Default: ``False``
+        lazy (bool): If False start evaluating the model parameters so they
+            are loaded in memory in the background, otherwise they will be
+            loaded when needed. Use ``mx.eval(model.parameters())`` to wait
+            for them, e.g. before timing generation. Default: ``False``
     Returns:
         Tuple[nn.Module, TokenizerWrapper]: A tuple containing the loaded model and tokenizer.
 
@@ -524,26 +813,47 @@ def fetch_from_hub(
     return model, config, tokenizer
 
 
-def make_shards(weights: dict, max_file_size_gb: int = MAX_FILE_SIZE_GB) -> list:
+def make_shards(
+    weights: dict,
+    max_file_size_gb: int = MAX_FILE_SIZE_GB,
+    *,
+    donate_weights: bool = False,
+) -> list:
     """
-    Splits the weights into smaller shards.
+    Splits the weights into smaller shards. The weights of a layer are kept in
+    the same shard unless the layer does not fit in a single shard.
 
     Args:
         weights (dict): Model weights.
         max_file_size_gb (int): Maximum size of each shard in gigabytes.
+        donate_weights (bool): If ``True``, weights are removed from
+          ``weights`` as they are assigned to a shard. Default: ``False``.
 
     Returns:
         list: List of weight shards.
     """
     max_file_size_bytes = max_file_size_gb << 30
+
+    groups = {}
+    for k in weights:
+        match = LAYER_PREFIX_PATTERN.match(k)
+        groups.setdefault(match.group(1) if match else k, []).append(k)
+
     shards = []
     shard, shard_size = {}, 0
-    for k, v in weights.items():
-        if shard_size + v.nbytes > max_file_size_bytes:
+    for keys in groups.values():
+        group_size = sum(weights[k].nbytes for k in keys)
+        if shard and shard_size + group_size > max_file_size_bytes:
             shards.append(shard)
             shard, shard_size = {}, 0
-        shard[k] = v
-        shard_size += v.nbytes
+        for k in keys:
+            v = weights.pop(k) if donate_weights else weights[k]
+            # Only reached for a group larger than a whole shard
+            if shard and shard_size + v.nbytes > max_file_size_bytes:
+                shards.append(shard)
+                shard, shard_size = {}, 0
+            shard[k] = v
+            shard_size += v.nbytes
     shards.append(shard)
     return shards
 
@@ -622,38 +932,52 @@ def save_weights(
         save_path = Path(save_path)
     save_path.mkdir(parents=True, exist_ok=True)
 
-    shards = make_shards(weights)
-    shards_count = len(shards)
-    shard_file_format = (
-        "model-{:05d}-of-{:05d}.safetensors"
-        if shards_count > 1
-        else "model.safetensors"
-    )
-
     total_size = sum(v.nbytes for v in weights.values())
     index_data = {"metadata": {"total_size": total_size}, "weight_map": {}}
 
-    # Write the weights and make sure no references are kept other than the
-    # necessary ones
+    # Sort once so the shards, and hence the weight map, are in key order
+    sorted_weights = dict(sorted(weights.items()))
+
+    # Make sure no references are kept to the weights other than the ones
+    # held by the shards
     if donate_weights:
         weights.clear()
-        del weights
-
-    for i in range(len(shards)):
-        shard = shards[i]
-        shards[i] = None
-        shard_name = shard_file_format.format(i + 1, shards_count)
-        shard_path = save_path / shard_name
+    del weights
+    shards = make_shards(sorted_weights, donate_weights=donate_weights)
+    del sorted_weights
 
-        mx.save_safetensors(str(shard_path), shard, metadata={"format": "mlx"})
+    shards_count = len(shards)
+    shard_file_format = (
+        "model-{:05d}-of-{:05d}.safetensors"
+        if shards_count > 1
+        else "model.safetensors"
+    )
 
-        for weight_name in shard.keys():
-            index_data["weight_map"][weight_name] = shard_name
-        del shard
+    # Evaluate each shard on this thread while a writer thread flushes the
+    # previous one to disk. At most two shards are materialized at a time and
+    # each is released as soon as it is written.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = None
+        for i in range(shards_count):
+            shard = shards.pop(0)
+            shard_name = shard_file_format.format(i + 1, shards_count)
+            shard_path = save_path / shard_name
+
+            mx.eval(shard)
+            if pending is not None:
+                pending.result()
+            pending = executor.submit(
+                mx.save_safetensors,
+                str(shard_path),
+                shard,
+                metadata={"format": "mlx"},
+            )
 
-    index_data["weight_map"] = {
-        k: index_data["weight_map"][k] for k in sorted(index_data["weight_map"])
-    }
+            for weight_name in shard.keys():
+                index_data["weight_map"][weight_name] = shard_name
+            del shard
+        if pending is not None:
+            pending.result()
 
     with open(save_path / "model.safetensors.index.json", "w") as f:
         json.dump(
@@ -736,22 +1060,23 @@ def convert(
     model_path = get_model_path(hf_path, revision=revision)
     model, config, tokenizer = fetch_from_hub(model_path, lazy=True)
 
-    weights = dict(tree_flatten(model.parameters()))
-    dtype = getattr(mx, dtype)
-    weights = {k: v.astype(dtype) for k, v in weights.items()}
-
     if quantize and dequantize:
         raise ValueError("Choose either quantize or dequantize, not both.")
 
-    if quantize:
-        print("[INFO] Quantizing")
-        model.load_weights(list(weights.items()))
-        weights, config = quantize_model(model, config, q_group_size, q_bits)
-
     if dequantize:
         print("[INFO] Dequantizing")
         model = dequantize_model(model)
         weights = dict(tree_flatten(model.parameters()))
+    else:
+        # Cast the parameters in place rather than building a casted copy of
+        # the weights. Everything stays lazy, so each weight is only
+        # materialized when the shard holding it is written.
+        model.set_dtype(getattr(mx, dtype))
+        if quantize:
+            print("[INFO] Quantizing")
+            weights, config = quantize_model(model, config, q_group_size, q_bits)
+        else:
+            weights = dict(tree_flatten(model.parameters()))
 
     del model
     save_weights(mlx_path, weights, donate_weights=True)
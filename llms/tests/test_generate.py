@@ -1,8 +1,23 @@
 # Copyright © 2024 Apple Inc.
 
+import time
 import unittest
 
-from mlx_lm.utils import generate, load
+import mlx.core as mx
+from mlx_lm.models import llama
+from mlx_lm.utils import RATE_LIMIT_BURST, generate, generate_step, load
+
+
+def tiny_model_args():
+    return llama.ModelArgs(
+        model_type="llama",
+        hidden_size=32,
+        num_hidden_layers=2,
+        intermediate_size=64,
+        num_attention_heads=4,
+        rms_norm_eps=1e-5,
+        vocab_size=100,
+    )
 
 
 class TestGenerate(unittest.TestCase):
@@ -51,5 +66,73 @@ class TestGenerate(unittest.TestCase):
         self.assertEqual(len(all_toks), len(init_toks) + 5)
 
 
+class TestGenerateStep(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.model = llama.Model(tiny_model_args())
+        cls.prompt = mx.array([1, 2, 3, 4, 5])
+
+    def generate_tokens(self, num_tokens, **kwargs):
+        return [
+            token
+            for _, (token, _) in zip(
+                range(num_tokens), generate_step(self.prompt, self.model, **kwargs)
+            )
+        ]
+
+    def test_token_batch_size(self):
+        for kwargs in [{}, {"repetition_penalty": 1.5}]:
+            expected = self.generate_tokens(10, token_batch_size=1, **kwargs)
+            tokens = self.generate_tokens(10, token_batch_size=4, **kwargs)
+            self.assertEqual(tokens, expected)
+
+        with self.assertRaises(ValueError):
+            self.generate_tokens(1, token_batch_size=0)
+
+    def test_max_tokens_per_sec(self):
+        num_tokens, rate = 20, 100
+        tic = time.perf_counter()
+        self.generate_tokens(num_tokens, max_tokens_per_sec=rate)
+        elapsed = time.perf_counter() - tic
+        self.assertGreaterEqual(elapsed, (num_tokens - RATE_LIMIT_BURST) / rate)
+        # Generating the tokens takes a small fraction of the limit, so the
+        # elapsed time is close to it unless the limiter sleeps too long
+        self.assertLess(elapsed, num_tokens / rate + 0.1)
+
+        with self.assertRaises(ValueError):
+            self.generate_tokens(1, max_tokens_per_sec=0)
+
+    def test_logit_bias(self):
+        logit_bias = {0: 5.0, 7: -3.0, 42: 1.5}
+        indices = mx.array(list(logit_bias.keys()))
+        values = mx.array(list(logit_bias.values()))
+
+        def scatter_add_processor(_, logits):
+            logits[:, indices] += values
+            return logits
+
+        results = zip(
+            range(5),
+            generate_step(
+                self.prompt, self.model, logit_bias=logit_bias, include_logprobs=True
+            ),
+        )
+        expected = zip(
+            range(5),
+            generate_step(
+                self.prompt,
+                self.model,
+                logits_processor=[scatter_add_processor],
+                include_logprobs=True,
+            ),
+        )
+        for (_, (token, logprobs)), (_, (e_token, e_logprobs)) in zip(
+            results, expected
+        ):
+            self.assertEqual(token, e_token)
+            self.assertTrue(mx.allclose(logprobs, e_logprobs))
+
+
 if __name__ == "__main__":
     unittest.main()
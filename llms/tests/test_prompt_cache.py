@@ -6,6 +6,8 @@ import tempfile
 import unittest
 
 import mlx.core as mx
+from mlx_lm import utils
+from mlx_lm.models import llama
 from mlx_lm.models.cache import (
     KVCache,
     MambaCache,
@@ -20,6 +22,18 @@ from mlx_lm.utils import generate_step, load
 HF_MODEL_PATH = "mlx-community/Qwen1.5-0.5B-Chat-4bit"
 
 
+def tiny_model_args():
+    return llama.ModelArgs(
+        model_type="llama",
+        hidden_size=32,
+        num_hidden_layers=2,
+        intermediate_size=64,
+        num_attention_heads=4,
+        rms_norm_eps=1e-5,
+        vocab_size=100,
+    )
+
+
 class TestPromptCache(unittest.TestCase):
 
     @classmethod
@@ -120,13 +134,16 @@ class TestPromptCache(unittest.TestCase):
     def test_cache_with_generate(self):
         model, tokenizer = load(HF_MODEL_PATH)
         prompt = tokenizer.encode("this is a prompt", return_tensors="mlx")[0]
-        results = zip(range(4), generate_step(prompt, model))
+        results = zip(range(4), generate_step(prompt, model, include_logprobs=True))
         toks, all_logits = zip(*(r[1] for r in results))
 
         prompt_cache = make_prompt_cache(model)
         i = 0
         for _, (tok, logits) in zip(
-            range(2), generate_step(prompt, model, prompt_cache=prompt_cache)
+            range(2),
+            generate_step(
+                prompt, model, prompt_cache=prompt_cache, include_logprobs=True
+            ),
         ):
             self.assertEqual(tok, toks[i])
             self.assertTrue(mx.allclose(logits, all_logits[i]))
@@ -134,7 +151,12 @@ class TestPromptCache(unittest.TestCase):
 
         for _, (tok, logits) in zip(
             range(1),
-            generate_step(mx.array([toks[i]]), model, prompt_cache=prompt_cache),
+            generate_step(
+                mx.array([toks[i]]),
+                model,
+                prompt_cache=prompt_cache,
+                include_logprobs=True,
+            ),
         ):
             i += 1
             self.assertEqual(tok, toks[i])
@@ -198,7 +220,10 @@ class TestPromptCache(unittest.TestCase):
 
         # Generate two more tokens
         results = zip(
-            range(2), generate_step(last_tok, model, prompt_cache=prompt_cache)
+            range(2),
+            generate_step(
+                last_tok, model, prompt_cache=prompt_cache, include_logprobs=True
+            ),
         )
         toks, all_logits = zip(*(r[1] for r in results))
 
@@ -208,7 +233,10 @@ class TestPromptCache(unittest.TestCase):
 
         # Generate the same thing again
         results = zip(
-            range(2), generate_step(last_tok, model, prompt_cache=prompt_cache)
+            range(2),
+            generate_step(
+                last_tok, model, prompt_cache=prompt_cache, include_logprobs=True
+            ),
         )
         second_toks, second_all_logits = zip(*(r[1] for r in results))
         self.assertEqual(toks, second_toks)
@@ -216,6 +244,100 @@ class TestPromptCache(unittest.TestCase):
             all(mx.allclose(l, l2) for l, l2 in zip(all_logits, second_all_logits))
         )
 
+    def test_cache_offset_after_early_stop(self):
+        model = llama.Model(tiny_model_args())
+
+        # The second prompt fills a rotating cache, which then cannot be trimmed
+        for prompt, max_kv_size in [
+            (mx.array([1, 2, 3, 4, 5]), None),
+            (mx.arange(40), 16),
+        ]:
+            for token_batch_size in [1, 4]:
+                prompt_cache = make_prompt_cache(model, max_kv_size)
+                for _ in zip(
+                    range(3),
+                    generate_step(
+                        prompt,
+                        model,
+                        prompt_cache=prompt_cache,
+                        token_batch_size=token_batch_size,
+                    ),
+                ):
+                    pass
+
+                # The prompt and all the consumed tokens have been processed
+                self.assertEqual(prompt_cache[0].offset, prompt.size + 3)
+
+    def test_prefix_cache(self):
+        class CountingModel(llama.Model):
+            num_processed = 0
+
+            def __call__(self, inputs, cache=None):
+                self.num_processed += inputs.size
+                return super().__call__(inputs, cache=cache)
+
+        model = CountingModel(tiny_model_args())
+        utils._prefix_cache.clear()
+
+        prompt = mx.arange(200) % 100
+        prompt_cache, remaining = utils._fetch_prefix_cache(model, prompt)
+        self.assertEqual(model.num_processed, 192)
+        self.assertEqual(remaining.size, 8)
+
+        # A prompt sharing the first 89 tokens reuses them
+        other = mx.concatenate([prompt[:89], mx.arange(111) % 7])
+        model.num_processed = 0
+        prompt_cache, remaining = utils._fetch_prefix_cache(model, other)
+        self.assertEqual(model.num_processed, 192 - 89)
+        self.assertEqual(prompt_cache[0].offset, 192)
+        self.assertEqual(remaining.size, 8)
+
+        # The reused cache gives the same logits as processing from scratch
+        logits = model(remaining[None], cache=prompt_cache)
+        expected = model(other[None], cache=make_prompt_cache(model))
+        self.assertTrue(mx.allclose(logits[:, -1], expected[:, -1], atol=1e-4))
+
+        # An extension of a stored prefix reuses all of it
+        model.num_processed = 0
+        extended = mx.concatenate([other, mx.arange(64)])
+        _, remaining = utils._fetch_prefix_cache(model, extended)
+        self.assertEqual(model.num_processed, 64)
+        self.assertEqual(remaining.size, 8)
+        utils._prefix_cache.clear()
+
+    def test_prefix_cache_repetition_penalty(self):
+        class Tokenizer:
+            eos_token_id = None
+            clean_up_tokenization_spaces = False
+
+            def encode(self, text):
+                return [int(t) for t in text.split()]
+
+            def decode(self, tokens):
+                return "".join(f" {t}" for t in tokens)
+
+        model = llama.Model(tiny_model_args())
+        tokenizer = Tokenizer()
+        utils._prefix_cache.clear()
+
+        # Most of the prompt is in the stored prefix, but all of the last 20
+        # tokens still count towards the repetition penalty
+        prompt = " ".join(map(str, mx.random.randint(0, 100, (70,)).tolist()))
+        expected = utils.generate(
+            model, tokenizer, prompt, max_tokens=10, repetition_penalty=50.0
+        )
+        for _ in range(2):
+            response = utils.generate(
+                model,
+                tokenizer,
+                prompt,
+                max_tokens=10,
+                repetition_penalty=50.0,
+                prefix_cache=True,
+            )
+            self.assertEqual(response, expected)
+        utils._prefix_cache.clear()
+
     def test_cache_copying(self):
         cache = [KVCache()]
 
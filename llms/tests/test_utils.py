@@ -54,6 +54,20 @@ class TestUtils(unittest.TestCase):
         shards = utils.make_shards(dict(weights), 1)
         self.assertTrue(gb <= len(shards) <= gb + 1)
 
+        # Layers are not split across shards
+        for i in range(args.num_hidden_layers):
+            prefix = f"model.layers.{i}."
+            self.assertEqual(
+                sum(any(k.startswith(prefix) for k in shard) for shard in shards), 1
+            )
+
+    def test_apply_repetition_penalty(self):
+        logits = mx.array([[2.0, -2.0, 1.0, -1.0]])
+        tokens = mx.array([0, 1, 1, 0])
+        logits = utils.apply_repetition_penalty(logits, tokens, 2.0)
+        expected = mx.array([[1.0, -4.0, 1.0, -1.0]])
+        self.assertTrue(mx.allclose(logits, expected))
+
     def test_quantize(self):
         from mlx_lm.models import llama
 